@@ -1,33 +1,60 @@
+import io
 import os
 import math
-import uuid
 import zipfile
-import random
-import gc
-from flask import Flask, render_template, request, jsonify
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from flask import Flask, render_template, request, jsonify, send_file
+import PIL
 from PIL import Image, ImageDraw
 
 app = Flask(__name__)
 
-# CONFIGURATION
-UPLOAD_FOLDER = 'uploads'
-OUTPUT_FOLDER = 'static/generated'
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+# Bind frequently used attributes once instead of resolving them per call.
+_sqrt = math.sqrt
+_RESAMPLE = Image.Resampling.BILINEAR
+
+# Pillow-SIMD versions carry a ".post" suffix (e.g. "9.0.0.post1").
+if '.post' not in PIL.__version__:
+    app.logger.warning("Pillow-SIMD not detected (Pillow %s); using the slower stock build.", PIL.__version__)
+
 
 def calculate_grid(width, height, num_pieces):
     aspect_ratio = width / height
-    rows = int(math.sqrt(num_pieces / aspect_ratio))
-    cols = int(num_pieces / max(rows, 1))
-    return max(1, rows), max(1, cols)
+    # Round rows to the nearest fit and take the ceiling for cols so the
+    # grid never comes up short of the requested piece count.
+    rows = max(1, round(_sqrt(num_pieces / aspect_ratio)))
+    cols = max(1, math.ceil(num_pieces / rows))
+    return rows, cols
 
+@functools.lru_cache(maxsize=32)
 def get_square_tab_points(length, is_tab=True):
+    # Only four (length, is_tab) combinations exist per session, so the
+    # templates are computed once and shared by every piece and cut line.
     tab_width = length * 0.3
     tab_height = length * 0.2
     x1 = (length - tab_width) / 2
     x2 = x1 + tab_width
     y_offset = tab_height if is_tab else -tab_height
-    return [(x1, 0), (x1, y_offset), (x2, y_offset), (x2, 0)]
+    return ((x1, 0), (x1, y_offset), (x2, y_offset), (x2, 0))
+
+@functools.lru_cache(maxsize=32)
+def get_side_polylines(piece_w, piece_h):
+    # Pre-transform the tab templates into mask coordinates for all 8
+    # (side, tab/hole) combinations; constant for a given piece size.
+    padding = max(piece_w, piece_h) * 0.3
+    tl, tr, bl = (padding, padding), (padding + piece_w, padding), (padding, padding + piece_h)
+    sides = {}
+    for parity, is_tab in ((1, True), (-1, False)):
+        w_pts = get_square_tab_points(piece_w, is_tab)
+        h_pts = get_square_tab_points(piece_h, is_tab)
+        sides[(0, parity)] = tuple((tl[0] + px, tl[1] - py) for px, py in w_pts)
+        sides[(1, parity)] = tuple((tr[0] + py, tr[1] + px) for px, py in h_pts)
+        sides[(2, parity)] = tuple((bl[0] + (piece_w - px), bl[1] + py) for px, py in w_pts)
+        sides[(3, parity)] = tuple((tl[0] - py, tl[1] + (piece_h - px)) for px, py in h_pts)
+    return sides
 
 def create_piece_mask(piece_w, piece_h, edge_shapes):
     padding = max(piece_w, piece_h) * 0.3
@@ -35,111 +62,171 @@ def create_piece_mask(piece_w, piece_h, edge_shapes):
     mask = Image.new('L', (mask_w, mask_h), 0)
     draw = ImageDraw.Draw(mask)
     tl, tr, br, bl = (padding, padding), (padding + piece_w, padding), (padding + piece_w, padding + piece_h), (padding, padding + piece_h)
+    sides = get_side_polylines(piece_w, piece_h)
     points = [tl]
 
     # Top
     if edge_shapes[0] != 0:
-        for px, py in get_square_tab_points(piece_w, (edge_shapes[0] == 1)):
-            points.append((tl[0] + px, tl[1] - py))
+        points.extend(sides[(0, edge_shapes[0])])
     points.append(tr)
     # Right
     if edge_shapes[1] != 0:
-        for px, py in get_square_tab_points(piece_h, (edge_shapes[1] == 1)):
-            points.append((tr[0] + py, tr[1] + px))
+        points.extend(sides[(1, edge_shapes[1])])
     points.append(br)
     # Bottom
     if edge_shapes[2] != 0:
-        for px, py in get_square_tab_points(piece_w, (edge_shapes[2] == 1)):
-            points.append((bl[0] + (piece_w - px), bl[1] + py))
+        points.extend(sides[(2, edge_shapes[2])])
     points.append(bl)
     # Left
     if edge_shapes[3] != 0:
-        for px, py in get_square_tab_points(piece_h, (edge_shapes[3] == 1)):
-            points.append((tl[0] - py, tl[1] + (piece_h - px)))
+        points.extend(sides[(3, edge_shapes[3])])
 
     draw.polygon(points, fill=255)
     return mask, padding, points
 
-def draw_cut_lines_on_full_image(img_data, rows, cols, output_path, h_edges, v_edges, margin_px):
-    with img_data.copy().convert("RGB") as img:
+@functools.lru_cache(maxsize=128)
+def cached_piece_mask(piece_w, piece_h, edge_shapes):
+    # piece_w/piece_h are constant per session, so at most 3^4 = 81 distinct
+    # edge signatures ever get rasterized; everything else is a dict hit.
+    return create_piece_mask(piece_w, piece_h, edge_shapes)
+
+@functools.lru_cache(maxsize=128)
+def cached_mask_array(piece_w, piece_h, edge_shapes):
+    # The render loop wants the mask as numpy; cache that form directly so
+    # repeats skip the PIL-to-ndarray copy as well as the rasterization.
+    mask, padding, _ = cached_piece_mask(piece_w, piece_h, edge_shapes)
+    arr = np.asarray(mask)
+    arr.setflags(write=False)
+    return arr, padding
+
+def draw_cut_lines_on_full_image(img_data, rows, cols, output, h_edges, v_edges, margin_px):
+    # convert() already returns a detached image; no defensive copy needed.
+    with img_data.convert("RGB") as img:
         draw = ImageDraw.Draw(img)
         width, height = img.size 
         inner_w, inner_h = width - (2 * margin_px), height - (2 * margin_px)
         piece_w, piece_h = inner_w / cols, inner_h / rows
 
-        def draw_contrasted_line(pts):
-            draw.line(pts, fill=(0, 0, 0), width=3)
-            draw.line(pts, fill=(255, 255, 255), width=1)
+        # Tab templates are fixed per session; look them up once, not per edge.
+        tab_pts_h = (get_square_tab_points(piece_h, False), get_square_tab_points(piece_h, True))
+        tab_pts_w = (get_square_tab_points(piece_w, False), get_square_tab_points(piece_w, True))
+
+        segments = []
 
-        # Draw Vertical internal cuts
+        # Collect Vertical internal cuts
         for r in range(rows):
             for c in range(1, cols):
                 x_base, y_start, y_end = margin_px + (c * piece_w), margin_px + (r * piece_h), margin_px + ((r + 1) * piece_h)
-                tab_pts = get_square_tab_points(piece_h, (v_edges[r][c-1] == 1))
-                pts = [(x_base, y_start)] + [(x_base + py, y_start + px) for px, py in tab_pts] + [(x_base, y_end)]
-                draw_contrasted_line(pts)
+                tab_pts = tab_pts_h[1] if v_edges[r][c-1] == 1 else tab_pts_h[0]
+                segments.append([(x_base, y_start)] + [(x_base + py, y_start + px) for px, py in tab_pts] + [(x_base, y_end)])
 
-        # Draw Horizontal internal cuts
+        # Collect Horizontal internal cuts
         for r in range(1, rows):
             for c in range(cols):
                 y_base, x_start, x_end = margin_px + (r * piece_h), margin_px + (c * piece_w), margin_px + ((c + 1) * piece_w)
-                tab_pts = get_square_tab_points(piece_w, (h_edges[r-1][c] == 1))
-                pts = [(x_start, y_base)] + [(x_start + px, y_base + py) for px, py in tab_pts] + [(x_end, y_base)]
-                draw_contrasted_line(pts)
+                tab_pts = tab_pts_w[1] if h_edges[r-1][c] == 1 else tab_pts_w[0]
+                segments.append([(x_start, y_base)] + [(x_start + px, y_base + py) for px, py in tab_pts] + [(x_end, y_base)])
+
+        # Two grouped passes: all black underlays, then all white centers.
+        line = draw.line
+        for pts in segments:
+            line(pts, fill=(0, 0, 0), width=3)
+        for pts in segments:
+            line(pts, fill=(255, 255, 255), width=1)
 
         # Draw the Outer Frame Box LAST (to keep it clean)
         draw.rectangle([margin_px, margin_px, width - margin_px, height - margin_px], outline=(0, 0, 0), width=3)
 
-        img.save(output_path, "JPEG", quality=85)
-        return output_path
-
-def process_image(image_path, num_pieces, session_id):
-    with Image.open(image_path).convert("RGBA") as original_full:
-        MAX_RES = 1000
-        if max(original_full.size) > MAX_RES:
-            original_full.thumbnail((MAX_RES, MAX_RES), Image.Resampling.LANCZOS)
-        img_w, img_h = original_full.size
-        margin_px = int(min(img_w, img_h) * 0.05)
-        inner_w, inner_h = img_w - (2 * margin_px), img_h - (2 * margin_px)
-        rows, cols = calculate_grid(inner_w, inner_h, num_pieces)
-        piece_w, piece_h = inner_w / cols, inner_h / rows
-        img_data = original_full.copy()
-
-    session_dir = os.path.join(OUTPUT_FOLDER, session_id)
-    pieces_dir = os.path.join(session_dir, "pieces")
-    os.makedirs(pieces_dir, exist_ok=True)
-
-    v_edges = [[random.choice([1, -1]) for _ in range(cols - 1)] for _ in range(rows)]
-    h_edges = [[random.choice([1, -1]) for _ in range(cols)] for _ in range(rows - 1)]
-
-    guide_path = os.path.join(session_dir, "PRINT_THIS_GUIDE.jpg")
-    draw_cut_lines_on_full_image(img_data, rows, cols, guide_path, h_edges, v_edges, margin_px)
-
-    for r in range(rows):
-        for c in range(cols):
-            edges = (0 if r==0 else -h_edges[r-1][c], 0 if c==cols-1 else v_edges[r][c], 0 if r==rows-1 else h_edges[r][c], 0 if c==0 else -v_edges[r][c-1])
-            mask, padding, _ = create_piece_mask(piece_w, piece_h, edges)
-            crop_x, crop_y = int(margin_px + (c * piece_w) - padding), int(margin_px + (r * piece_h) - padding)
-            with Image.new('RGBA', mask.size, (0, 0, 0, 0)) as piece_img:
-                src_x, src_y = max(0, crop_x), max(0, crop_y)
-                src_w, src_h = min(img_w, crop_x + mask.size[0]) - src_x, min(img_h, crop_y + mask.size[1]) - src_y
+        # Single-scan baseline encode; 4:4:4 keeps the thin cut lines crisp
+        # for printing.
+        img.save(output, "JPEG", quality=85, optimize=False, progressive=False, subsampling=0)
+        return output
+
+def process_image(image_file, num_pieces):
+    # Aim for ~200px per piece side, capped at MAX_RES; small puzzles don't
+    # need (or benefit from) a 1000px working image.
+    MAX_RES = 1000
+    target_res = min(MAX_RES, int(_sqrt(num_pieces) * 200))
+    with Image.open(image_file) as src:
+        # JPEGs can be decoded straight to a smaller size in the DCT domain;
+        # draft() is a no-op for other formats. Ask for 2x the target so the
+        # remaining resize stays small.
+        src.draft('RGB', (target_res * 2, target_res * 2))
+        # Keep the working image RGB: only the final piece tiles need alpha,
+        # and it comes from the mask, not the source.
+        original_full = src.convert("RGB")
+    if max(original_full.size) > target_res:
+        # After draft() the residual scale is near-integer, where bilinear is
+        # visually equivalent to Lanczos and much cheaper.
+        original_full.thumbnail((target_res, target_res), _RESAMPLE)
+    img_w, img_h = original_full.size
+    margin_px = int(min(img_w, img_h) * 0.05)
+    inner_w, inner_h = img_w - (2 * margin_px), img_h - (2 * margin_px)
+    rows, cols = calculate_grid(inner_w, inner_h, num_pieces)
+    piece_w, piece_h = inner_w / cols, inner_h / rows
+
+    rng = np.random.default_rng()
+    edge_values = np.array([1, -1], dtype=np.int8)
+    v_edges = rng.choice(edge_values, size=(rows, cols - 1))
+    h_edges = rng.choice(edge_values, size=(rows - 1, cols))
+
+    guide_buf = io.BytesIO()
+    draw_cut_lines_on_full_image(original_full, rows, cols, guide_buf, h_edges, v_edges, margin_px)
+
+    # One numpy view of the source; per-piece slices are zero-copy.
+    src_arr = np.asarray(original_full)
+
+    # Crop geometry is separable in r and c; precompute the clamped integer
+    # boxes vectorized. padding and the mask size mirror create_piece_mask.
+    padding = max(piece_w, piece_h) * 0.3
+    mask_w, mask_h = int(piece_w + padding * 2), int(piece_h + padding * 2)
+    crop_xs = (margin_px + np.arange(cols) * piece_w - padding).astype(np.int32)
+    crop_ys = (margin_px + np.arange(rows) * piece_h - padding).astype(np.int32)
+    src_xs, src_ys = np.maximum(0, crop_xs), np.maximum(0, crop_ys)
+    src_ws = np.minimum(img_w, crop_xs + mask_w) - src_xs
+    src_hs = np.minimum(img_h, crop_ys + mask_h) - src_ys
+
+    zip_buf = io.BytesIO()
+    zip_lock = threading.Lock()
+
+    # WebP/JPEG entries are already compressed, so store them instead of
+    # re-deflating.
+    with zipfile.ZipFile(zip_buf, 'w', compression=zipfile.ZIP_STORED) as zipf:
+        zipf.writestr("PRINT_THIS_GUIDE.jpg", guide_buf.getvalue())
+
+        def render_row(r):
+            # All masks in a session share one shape, so each worker keeps a
+            # single scratch tile and re-fills it instead of reallocating.
+            out = np.empty((mask_h, mask_w, 4), dtype=np.uint8)
+            # Work within one horizontal band of the source per row so the
+            # band (not the whole image) is what stays hot in cache.
+            src_y, src_h = src_ys[r], src_hs[r]
+            dy = src_y - crop_ys[r]
+            band = src_arr[src_y:src_y + src_h]
+            for c in range(cols):
+                edges = (0 if r==0 else -h_edges[r-1][c], 0 if c==cols-1 else v_edges[r][c], 0 if r==rows-1 else h_edges[r][c], 0 if c==0 else -v_edges[r][c-1])
+                mask_arr, _ = cached_mask_array(piece_w, piece_h, edges)
+                out.fill(0)
+                src_x, src_w = src_xs[c], src_ws[c]
                 if src_w > 0 and src_h > 0:
-                    chunk = img_data.crop((src_x, src_y, src_x + src_w, src_y + src_h))
-                    piece_img.paste(chunk, (src_x - crop_x, src_y - crop_y))
-                    chunk.close()
-                piece_img.putalpha(mask)
-                piece_img.save(os.path.join(pieces_dir, f"piece_{r}_{c}.png"), compress_level=1)
-        gc.collect()
-
-    zip_path = os.path.join(session_dir, "puzzle_pack.zip")
-    with zipfile.ZipFile(zip_path, 'w') as zipf:
-        zipf.write(guide_path, "PRINT_THIS_GUIDE.jpg")
-        for root, _, files in os.walk(pieces_dir):
-            for file in files:
-                zipf.write(os.path.join(root, file), os.path.join("individual_pieces", file))
-    
-    img_data.close()
-    return zip_path
+                    dx = src_x - crop_xs[c]
+                    out[dy:dy + src_h, dx:dx + src_w, :3] = band[:, src_x:src_x + src_w]
+                    out[dy:dy + src_h, dx:dx + src_w, 3] = mask_arr[dy:dy + src_h, dx:dx + src_w]
+                buf = io.BytesIO()
+                # Lossless WebP at method=0 encodes much faster than zlib-based
+                # PNG and still comes out smaller for these continuous-tone tiles.
+                Image.fromarray(out, 'RGBA').save(buf, 'WEBP', lossless=True, quality=0, method=0)
+                with zip_lock:
+                    zipf.writestr(f"individual_pieces/piece_{r}_{c}.webp", buf.getvalue())
+
+        # Rows are independent and PIL releases the GIL around the C-level
+        # slicing/encode work, so threads give real parallelism here.
+        with ThreadPoolExecutor(max_workers=min(os.cpu_count() or 1, rows)) as executor:
+            list(executor.map(render_row, range(rows)))
+
+    original_full.close()
+    zip_buf.seek(0)
+    return zip_buf
 
 @app.route('/')
 def index(): return render_template('index.html')
@@ -150,13 +237,10 @@ def generate():
     file = request.files['image']
     try: pieces = int(request.form.get('pieces', 25))
     except: pieces = 25
-    session_id = str(uuid.uuid4())
-    img_path = os.path.join(UPLOAD_FOLDER, f"{session_id}.png")
-    file.save(img_path)
     try:
-        zip_path = process_image(img_path, pieces, session_id)
-        os.remove(img_path)
-        return jsonify({'download_url': f"/static/generated/{session_id}/puzzle_pack.zip"})
+        # PIL reads the upload's spooled temp file directly; no disk round-trip.
+        zip_buf = process_image(file.stream, pieces)
+        return send_file(zip_buf, mimetype='application/zip', as_attachment=True, download_name='puzzle_pack.zip')
     except Exception as e: return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
@@ -59,13 +59,17 @@ form.addEventListener('submit', async (e) => {
             body: formData
         });
 
-        const data = await response.json();
-
         if (response.ok) {
-            downloadLink.href = data.download_url;
+            // The server streams the zip back directly; wrap it in an object
+            // URL for the download button.
+            const blob = await response.blob();
+            if (downloadLink.href.startsWith('blob:')) URL.revokeObjectURL(downloadLink.href);
+            downloadLink.href = URL.createObjectURL(blob);
+            downloadLink.download = 'puzzle_pack.zip';
             loading.classList.add('hidden');
             result.classList.remove('hidden');
         } else {
+            const data = await response.json();
             alert("Error: " + data.error);
             resetUI();
         }